@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for labpack hot paths. No rig hardware needed: the LabJack is simulated.
+
+Each run appends its results, with the git commit and package versions, as one JSON line to the history
+file, and compares them to an earlier run on the same machine (by default the most recent one). A benchmark
+whose median time per call is more than --threshold slower than the baseline is reported as a
+regression, and the script exits with status 1.
+
+Usage:
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --filter GlIcosphere --baseline a32450b
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import subprocess
+from importlib import metadata
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+DEFAULT_HISTORY = os.path.join(REPO_DIR, 'benchmarks', 'history.jsonl')
+
+
+# %% Benchmarks. Each returns the function to time, after doing any setup
+
+def bench_icosphere(n_subdivisions):
+    def setup():
+        from labpack.visual_stim.example.shapes import GlIcosphere
+        return lambda: GlIcosphere(colors=(1, 1, 1, 1), n_subdivisions=n_subdivisions)
+    return setup
+
+def moving_ellipsoid_parameters(stim_time=4.0):
+    tv = lambda v0, v1: {'name': 'TVPairs', 'tv_pairs': [(0, v0), (stim_time, v1)], 'kind': 'linear'}
+    return {'x_length': 2, 'y_length': 1, 'z_length': 1, 'color': None,
+            'x': tv(-2, 2), 'y': tv(4, 6), 'z': tv(-2, 2),
+            'yaw': tv(0, 90*stim_time), 'pitch': tv(0, 90*stim_time), 'roll': tv(0, 0),
+            'n_subdivisions': 6}
+
+def bench_moving_ellipsoid_configure():
+    from labpack.visual_stim.example.stimuli import MovingEllipsoid
+    stim = MovingEllipsoid(screen=None)
+    parameters = moving_ellipsoid_parameters()
+    return lambda: stim.configure(**parameters)
+
+def bench_moving_ellipsoid_eval_at():
+    from labpack.visual_stim.example.stimuli import MovingEllipsoid
+    stim = MovingEllipsoid(screen=None)
+    stim.configure(**moving_ellipsoid_parameters())
+    frame = iter(range(10**9))
+    return lambda: stim.eval_at((next(frame) % 240) / 60)
+
+def bench_loom_gabb():
+    from labpack.visual_stim.example.trajectory import LoomGabb
+    loom = LoomGabb(rv_ratio=0.04, end_radius=60, collision_time=2.005)
+    frame = iter(range(10**9))
+    return lambda: loom.getValue((next(frame) % 180) / 60)
+
+def bench_sparse_binary():
+    from labpack.visual_stim.example.distribution import SparseBinary
+    noise = SparseBinary(rand_min=0, rand_max=1, sparseness=0.5)
+    return lambda: noise.get_random_values((30, 60))
+
+def bench_rot1_scale_rot2():
+    from labpack.visual_stim.example.util import rot1_scale_rot2
+    pts = np.random.rand(3, 3*720)
+    return lambda: rot1_scale_rot2(pts, 0.1, 0.2, 0.3, 2, 1, 1, 0.4, 0.5, 0.6)
+
+def bench_fictrac_parse_line():
+    from labpack.device.locomotion.loco_managers import fictrac_managers as ft
+    # Parse without starting FicTrac or opening a socket
+    manager = ft.FtClosedLoopManager.__new__(ft.FtClosedLoopManager)
+    manager.ft_frame_num_idx, manager.ft_timestamp_idx = ft.FT_FRAME_NUM_IDX, ft.FT_TIMESTAMP_IDX
+    manager.ft_theta_idx, manager.ft_x_idx, manager.ft_y_idx = ft.FT_THETA_IDX, ft.FT_X_IDX, ft.FT_Y_IDX
+    manager.ft_ball_diameter = 0.009
+    manager.prev_theta = 0
+    values = ['{:.6f}'.format(v) for v in np.random.rand(ft.FT_TIMESTAMP_IDX + 4)]
+    values[0] = '1234'
+    line = 'FT, ' + ', '.join(values)
+    return lambda: manager._parse_line(line)
+
+class SimulatedLJM():
+    """
+    Stands in for labjack.ljm: accepts every call the LabJackTSeries makes and records none of it.
+    """
+    class constants():
+        dtT4 = 4
+        dtT7 = 7
+
+    def openS(self, *args): return 1
+    def getHandleInfo(self, handle): return (self.constants.dtT7, 1, 470000000, 0, 0, 0)
+    def eWriteName(self, *args): pass
+    def eWriteNames(self, *args): pass
+    def nameToAddress(self, name): return (1000, 3)
+    def namesToAddresses(self, n, names): return ([1000]*n, [3]*n)
+    def periodicStreamOut(self, *args): pass
+    def eStreamStart(self, handle, scansPerRead, numAddresses, scanList, scanRate): return scanRate
+    def eStreamStop(self, handle): pass
+    def close(self, handle): pass
+
+def bench_labjack_pulse_wave():
+    from labpack.device import daq
+    daq.ljm = SimulatedLJM()
+    device = daq.LabJackTSeries()
+    return lambda: device.pulse_wave(output_channel='DAC0', pre_time=0, stim_time=0, freq=10, amp=2.5, pulse_width=0.01, scanRate=50000)
+
+BENCHMARKS = {**{'GlIcosphere(n_subdivisions={})'.format(n): bench_icosphere(n) for n in (1, 2, 4, 6, 8)},
+              'MovingEllipsoid.configure': bench_moving_ellipsoid_configure,
+              'MovingEllipsoid.eval_at': bench_moving_ellipsoid_eval_at,
+              'LoomGabb.getValue': bench_loom_gabb,
+              'SparseBinary.get_random_values': bench_sparse_binary,
+              'rot1_scale_rot2': bench_rot1_scale_rot2,
+              'FtClosedLoopManager._parse_line': bench_fictrac_parse_line,
+              'LabJackTSeries.pulse_wave': bench_labjack_pulse_wave}
+
+
+# %% Running and history
+
+def time_function(function, repeat=5, min_time=0.2):
+    """
+    Returns dict of median and min time per call (sec) over repeat runs, each of at least min_time.
+    """
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    per_call = np.array(timer.repeat(repeat=repeat, number=number)) / number
+    return {'median': float(np.median(per_call)), 'min': float(per_call.min()), 'number': number, 'repeat': repeat}
+
+def run_benchmarks(names, repeat=5, min_time=0.2):
+    results = {}
+    for name in names:
+        try:
+            function = BENCHMARKS[name]()
+        except ImportError as e:
+            print('{:<40} skipped: {}'.format(name, e))
+            continue
+        results[name] = time_function(function, repeat=repeat, min_time=min_time)
+        print('{:<40} {:>12.3f} us'.format(name, 1e6*results[name]['median']))
+    return results
+
+def get_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, text=True).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD', '--', 'labpack', 'server'], cwd=REPO_DIR) != 0
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_versions():
+    versions = {'python': platform.python_version()}
+    for package in ('numpy', 'scipy', 'stimpack', 'icosphere'):
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+def load_history(history_path):
+    if not os.path.exists(history_path):
+        return []
+    with open(history_path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def append_history(history_path, entry):
+    os.makedirs(os.path.dirname(os.path.abspath(history_path)), exist_ok=True)
+    with open(history_path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+def compare(results, baseline, threshold=0.25):
+    """
+    Compare median times to a baseline history entry.
+
+    Returns list of (name, ratio) for benchmarks more than threshold slower than baseline.
+    """
+    regressions = []
+    print('Compared to {} ({}):'.format(baseline['commit'], baseline['time']))
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        ratio = result['median'] / baseline['results'][name]['median']
+        flag = 'REGRESSION' if ratio > 1 + threshold else ''
+        print('{:<40} {:>7.2f}x {}'.format(name, ratio, flag))
+        if flag:
+            regressions.append((name, ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark labpack hot paths.')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('--history', default=DEFAULT_HISTORY, help='JSON lines file of past results')
+    parser.add_argument('--baseline', default=None, help='commit to compare to. Defaults to the most recent run in the history')
+    parser.add_argument('--threshold', type=float, default=0.25, help='fractional slowdown reported as a regression')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min_time', type=float, default=0.2, help='(sec) minimum duration of each timed run')
+    parser.add_argument('--no_save', action='store_true', help='do not append results to the history')
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    results = run_benchmarks(names, repeat=args.repeat, min_time=args.min_time)
+
+    entry = {'commit': get_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+             'machine': platform.node(), 'versions': get_versions(), 'results': results}
+
+    # Only compare runs on the same machine
+    history = [h for h in load_history(args.history) if h['machine'] == entry['machine']]
+    if args.baseline is not None:
+        history = [h for h in history if h['commit'] is not None and h['commit'].startswith(args.baseline)]
+    regressions = compare(results, history[-1], threshold=args.threshold) if history else []
+
+    if not args.no_save:
+        append_history(args.history, entry)
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Post-hoc alignment of FicTrac, DAQ and stimulus timelines.
+
+Each stream has its own clock. fit_clock estimates the offset and drift between two clocks from events
+seen on both (e.g. stimulus frame flips recorded by the photodiode on the DAQ), with a robust
+regression that ignores missed or spurious events. Samples can then be moved onto another clock with
+ClockModel and resampled at arbitrary times with interpolate_at, or chunk by chunk with
+StreamingResampler for sessions too long to hold in memory.
+"""
+import numpy as np
+
+from labpack.device.locomotion.loco_managers.fictrac_managers import FT_FRAME_NUM_IDX, FT_X_IDX, FT_Y_IDX, FT_THETA_IDX, FT_TIMESTAMP_IDX
+
+
+class ClockModel():
+    """
+    Linear map between two clocks: t_dst = slope * t_src + offset
+    """
+    def __init__(self, slope=1.0, offset=0.0, residual_std=0.0, n_inliers=0):
+        self.slope = slope
+        self.offset = offset
+        self.residual_std = residual_std
+        self.n_inliers = n_inliers
+
+    @property
+    def drift(self):
+        """Drift of the destination clock relative to the source clock, in parts per million."""
+        return (self.slope - 1) * 1e6
+
+    def to_dst(self, t_src):
+        return self.slope * np.asarray(t_src) + self.offset
+
+    def to_src(self, t_dst):
+        return (np.asarray(t_dst) - self.offset) / self.slope
+
+    def __repr__(self):
+        return 'ClockModel(slope={:.9f}, offset={:.6f}, drift={:.1f} ppm, residual_std={:.2e})'.format(self.slope, self.offset, self.drift, self.residual_std)
+
+
+def fit_clock(t_src, t_dst, n_iter=10, threshold=3.0):
+    """
+    Robust fit of t_dst = slope * t_src + offset, from pairs of times of the same events on two clocks.
+
+    Least squares, then iteratively refit on the points within threshold median absolute deviations
+    of the fit, so outliers (mismatched events, dropped frames) don't bias it.
+
+    t_src: (sec) 1D array of event times on the source clock
+    t_dst: (sec) 1D array of the same events' times on the destination clock
+    n_iter: maximum number of refits
+    threshold: inlier threshold, in robust standard deviations of the residual
+
+    Returns ClockModel
+    """
+    t_src = np.asarray(t_src, dtype=float)
+    t_dst = np.asarray(t_dst, dtype=float)
+    assert t_src.shape == t_dst.shape and t_src.ndim == 1, 't_src and t_dst must be 1D arrays of the same length'
+    assert t_src.size >= 2, 'Need at least two events to fit a clock'
+
+    # Center for numerical stability with large timestamps
+    src_0 = t_src[0]
+    dst_0 = t_dst[0]
+    x = t_src - src_0
+    y = t_dst - dst_0
+
+    inliers = np.ones(x.size, dtype=bool)
+    for _ in range(n_iter):
+        slope, intercept = np.polyfit(x[inliers], y[inliers], 1)
+        residual = y - (slope * x + intercept)
+        center = np.median(residual[inliers])
+        mad = np.median(np.abs(residual[inliers] - center))
+        new_inliers = np.abs(residual - center) <= threshold * max(1.4826 * mad, np.finfo(float).eps * np.abs(y).max())
+        if new_inliers.sum() < 2 or np.array_equal(new_inliers, inliers):
+            break
+        inliers = new_inliers
+
+    offset = dst_0 + intercept - slope * src_0
+    return ClockModel(slope=slope, offset=offset, residual_std=float(np.std(residual[inliers])), n_inliers=int(inliers.sum()))
+
+def match_events(t_a, t_b, max_dt):
+    """
+    Pair each event in t_a with the nearest event in t_b, if it is within max_dt.
+    Both must be on the same (or approximately aligned) clock and sorted.
+
+    Returns (ind_a, ind_b) index arrays of the matched pairs.
+    """
+    t_a = np.asarray(t_a, dtype=float)
+    t_b = np.asarray(t_b, dtype=float)
+    if t_b.size == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    if t_b.size == 1:
+        nearest = np.zeros(t_a.size, dtype=int)
+    else:
+        right = np.clip(np.searchsorted(t_b, t_a), 1, t_b.size - 1)
+        left = right - 1
+        nearest = np.where(np.abs(t_b[left] - t_a) <= np.abs(t_b[right] - t_a), left, right)
+    matched = np.abs(t_b[nearest] - t_a) <= max_dt
+    return np.flatnonzero(matched), nearest[matched]
+
+def get_edge_times(t, signal, threshold=None, rising=True):
+    """
+    Times of threshold crossings in a sampled signal, e.g. a photodiode or frame trigger recorded on the DAQ.
+    Crossing times are linearly interpolated between samples.
+
+    threshold: defaults to halfway between the signal's min and max
+    rising: rising (True) or falling (False) edges
+    """
+    t = np.asarray(t, dtype=float)
+    signal = np.asarray(signal, dtype=float)
+    if threshold is None:
+        threshold = (signal.min() + signal.max()) / 2
+    above = signal > threshold
+    crossings = np.flatnonzero(above[1:] & ~above[:-1]) if rising else np.flatnonzero(~above[1:] & above[:-1])
+    frac = (threshold - signal[crossings]) / (signal[crossings + 1] - signal[crossings])
+    return t[crossings] + frac * (t[crossings + 1] - t[crossings])
+
+def interpolate_at(t_samples, values, t_query, period=None):
+    """
+    Linearly interpolate samples at query times, vectorized over time with searchsorted.
+    Query times outside the samples get NaN.
+
+    t_samples: sorted 1D array of sample times
+    values: array of samples, time along the first axis
+    t_query: 1D array of times to resample at, on the same clock as t_samples
+    period: if given, values are angles wrapping at period (e.g. 360) and are interpolated the short way round
+    """
+    t_samples = np.asarray(t_samples, dtype=float)
+    values = np.asarray(values, dtype=float)
+    t_query = np.asarray(t_query, dtype=float)
+
+    if t_samples.size < 2:
+        # Nothing to interpolate between: a single sample only covers its own time
+        resampled = np.full((t_query.size,) + values.shape[1:], np.nan)
+        if t_samples.size == 1:
+            resampled[t_query == t_samples[0]] = values[0]
+        return resampled
+
+    right = np.clip(np.searchsorted(t_samples, t_query, side='right'), 1, t_samples.size - 1)
+    left = right - 1
+    dt = t_samples[right] - t_samples[left]
+    weight = np.divide(t_query - t_samples[left], dt, out=np.zeros_like(t_query), where=dt > 0)
+    weight = weight.reshape((-1,) + (1,) * (values.ndim - 1))
+
+    delta = values[right] - values[left]
+    if period is not None:
+        delta = np.mod(delta + period / 2, period) - period / 2
+    resampled = values[left] + weight * delta
+
+    outside = (t_query < t_samples[0]) | (t_query > t_samples[-1])
+    resampled[outside] = np.nan
+    return resampled
+
+
+class StreamingResampler():
+    """
+    Resample a long stream at query times, one chunk of samples at a time.
+
+    Each call to update() takes the next chunk of samples and returns the resampled values for the query
+    times that the samples so far cover. The last sample of each chunk is kept so that query times between
+    chunks are interpolated across the boundary.
+
+    t_query: sorted 1D array of times to resample at, on the same clock as the samples
+    """
+    def __init__(self, t_query, period=None):
+        self.t_query = np.asarray(t_query, dtype=float)
+        self.period = period
+        self.next_query = 0
+        self.last_t = None
+        self.last_value = None
+
+    def update(self, t_samples, values):
+        """
+        Returns (query_indices, resampled_values) for the query times covered by this chunk.
+        """
+        t_samples = np.asarray(t_samples, dtype=float)
+        values = np.asarray(values, dtype=float)
+        if self.last_t is not None:
+            t_samples = np.concatenate(([self.last_t], t_samples))
+            values = np.concatenate((self.last_value[np.newaxis], values))
+
+        # Skip query times before the first sample
+        if self.last_t is None:
+            self.next_query = np.searchsorted(self.t_query, t_samples[0], side='left')
+        end = np.searchsorted(self.t_query, t_samples[-1], side='right')
+        query_indices = np.arange(self.next_query, end)
+
+        if t_samples.size >= 2:
+            resampled = interpolate_at(t_samples, values, self.t_query[query_indices], period=self.period)
+        else:
+            resampled = np.repeat(values, query_indices.size, axis=0)
+
+        self.next_query = end
+        self.last_t = t_samples[-1]
+        self.last_value = values[-1]
+        return query_indices, resampled
+
+
+def load_fictrac_dat(file_path, ft_ball_diameter=0.009, chunk_size=None):
+    """
+    Load FicTrac's .dat output, in the units FtClosedLoopManager._parse_line uses.
+
+    file_path: path to FicTrac .dat log
+    chunk_size: if given, return an iterator of dicts of chunk_size frames, for long sessions
+
+    Returns dict with 'frame_num', 'ts' (ms, FicTrac's clock), 'x', 'y' (m) and 'theta' (deg, unwrapped)
+    """
+    columns = (FT_FRAME_NUM_IDX, FT_TIMESTAMP_IDX, FT_X_IDX, FT_Y_IDX, FT_THETA_IDX)
+
+    def convert(data, prev_theta=None):
+        data = np.atleast_2d(data)
+        theta = -np.rad2deg(data[:, 4])
+        if prev_theta is not None:
+            theta = np.unwrap(np.concatenate(([prev_theta], theta)), period=360)[1:]
+        else:
+            theta = np.unwrap(theta, period=360)
+        return {'frame_num': data[:, 0].astype(int),
+                'ts': data[:, 1],
+                'x': (ft_ball_diameter/2) * data[:, 2],   # radians -> m
+                'y': -(ft_ball_diameter/2) * data[:, 3],  # radians -> m
+                'theta': theta}
+
+    if chunk_size is None:
+        return convert(np.loadtxt(file_path, delimiter=',', usecols=columns))
+
+    def chunks():
+        prev_theta = None
+        with open(file_path, 'r') as f:
+            while True:
+                lines = [line for _, line in zip(range(chunk_size), f)]
+                if not lines:
+                    return
+                chunk = convert(np.loadtxt(lines, delimiter=',', usecols=columns), prev_theta)
+                prev_theta = chunk['theta'][-1]
+                yield chunk
+    return chunks()
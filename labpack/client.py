@@ -1,8 +1,221 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import copy
+import time
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
 from stimpack.experiment import client
 
+from labpack import payload
+
 class Client(client.BaseClient):
     def __init__(self, cfg):
         super().__init__(cfg)  # call the parent class init method
+
+        # Render profile summaries pushed back by the server (see server/base_server.py get_render_profile)
+        self.render_profile = None
+        self.manager.register_function(self.receive_render_profile, name='receive_render_profile')
+
+        # Encode large NumPy arrays in requests as binary payloads, if the server agrees.
+        # Set binary_payloads: True in the rig's server_options to enable. Until then, and for requests
+        # that don't decode payloads, arrays are sent as lists.
+        self.binary_payloads = False
+        self.binary_payload_options = {'min_bytes': np.inf}
+        write_request_list = self.manager.write_request_list
+        self.manager.write_request_list = lambda request_list: write_request_list(
+            payload.encode_request_list(request_list, **self.binary_payload_options))
+
+        if self.server_options.get('binary_payloads', False):
+            stimuli = payload.DECODING_STIMULI | set(self.server_options.get('binary_payloads_stimuli', []))
+            self.negotiate_binary_payloads(min_bytes=self.server_options.get('binary_payloads_min_bytes', 4096),
+                                           compress=self.server_options.get('binary_payloads_compress', False),
+                                           stimuli=stimuli)
+
+    def negotiate_binary_payloads(self, min_bytes=4096, compress=False, stimuli=payload.DECODING_STIMULI, timeout=1.0):
+        '''
+        Ask the server whether it decodes binary payloads (labpack.payload), and if so encode NumPy arrays
+        of at least min_bytes in all subsequent requests that decode them: requests to the server's root
+        node, and loading the stimuli in stimuli. Arrays are sent as lists otherwise.
+
+        :param min_bytes: smallest array to send as a binary payload
+        :param compress: zlib-compress the payloads
+        :param stimuli: names of stimuli whose configure method decodes payloads (see labpack.payload.decode_payload)
+        :param timeout: (sec) how long to wait for the server's answer
+        '''
+        def binary_payloads_ack(version):
+            if version != payload.PAYLOAD_VERSION:
+                print('Server binary payload version {} does not match client version {}. Sending plain requests.'.format(version, payload.PAYLOAD_VERSION))
+                return
+            self.binary_payload_options = {'min_bytes': min_bytes, 'compress': compress, 'stimuli': stimuli}
+            self.binary_payloads = True
+
+        self.manager.register_function(binary_payloads_ack, name='binary_payloads_ack')
+        self.manager.binary_payloads_hello(version=payload.PAYLOAD_VERSION)
+
+        t0 = time.time()
+        while not self.binary_payloads and time.time() - t0 < timeout:
+            self.manager.process_queue()
+            time.sleep(0.01)
+        if not self.binary_payloads:
+            print('Server did not answer binary payload request. Sending plain requests.')
+        return self.binary_payloads
+
+    def receive_render_profile(self, summary):
+        self.render_profile = summary
+
+    def get_render_profile(self, timeout=2.0):
+        '''
+        Ask the server for its render profile summary and wait for it. The server must have been started
+        with a profile_dir.
+
+        :param timeout: (sec) how long to wait for the server's answer
+        Returns the summary dict, one entry per display process, or None on timeout.
+        '''
+        self.render_profile = None
+        self.manager.get_render_profile()
+
+        t0 = time.time()
+        while self.render_profile is None and time.time() - t0 < timeout:
+            self.manager.process_queue()
+            time.sleep(0.01)
+        if self.render_profile is None:
+            print('Server did not send a render profile. Was it started with profile_dir?')
+        return self.render_profile
+
+
+class MultiRigClient():
+    """
+    Drives several rig servers at once, one Client per rig in cfg['rig_config'].
+
+    Each rig runs its protocol in its own thread, so a slow rig does not serialize the others. Epoch
+    starts are synchronized across rigs: every rig waits at a barrier before each epoch, then all start
+    at a common time start_lead_time after the last rig arrives. After each epoch, each rig asks its
+    server for an acknowledgment (see server/base_server.py "request_ack"), collected in self.acks.
+
+    If a rig stops, fails, or does not reach the barrier within barrier_timeout, the barrier is broken
+    and the other rigs stop too.
+    """
+    def __init__(self, cfg, rig_names, start_lead_time=0.05, barrier_timeout=60.0, client_class=Client):
+        '''
+        :param cfg: config dict, as for Client
+        :param rig_names: list of rig names in cfg['rig_config']
+        :param start_lead_time: (sec) delay between the last rig reaching an epoch and the common epoch start
+        :param barrier_timeout: (sec) longest wait for the other rigs before an epoch. Should exceed the longest epoch
+        :param client_class: Client class to make for each rig
+        '''
+        self.rig_names = list(rig_names)
+        self.start_lead_time = start_lead_time
+        self.barrier_timeout = barrier_timeout
+
+        self.acks = {rig_name: [] for rig_name in self.rig_names}
+        self.ack_lock = threading.Lock()
+
+        # Connect to all rigs concurrently; local servers take a while to launch
+        def make_client(rig_name):
+            rig_cfg = copy.deepcopy(cfg)
+            rig_cfg['current_rig_name'] = rig_name
+            return client_class(rig_cfg)
+        with ThreadPoolExecutor(max_workers=len(self.rig_names)) as executor:
+            self.clients = dict(zip(self.rig_names, executor.map(make_client, self.rig_names)))
+
+        for rig_name, rig_client in self.clients.items():
+            rig_client.manager.register_function(lambda token, rig_name=rig_name: self.receive_ack(rig_name, token), name='receive_ack')
+
+        self.barrier = None
+        self.epoch_start_time = None
+
+    def receive_ack(self, rig_name, token):
+        with self.ack_lock:
+            self.acks[rig_name].append(token)
+
+    def _set_epoch_start_time(self):
+        # Runs once per barrier crossing, in the last thread to arrive
+        self.epoch_start_time = time.time() + self.start_lead_time
+
+    def _synchronize(self, rig_name, protocol_object):
+        """
+        Wrap the protocol's start_stimuli so each epoch starts at the same time on all rigs.
+        """
+        start_stimuli = protocol_object.start_stimuli
+        manager = self.clients[rig_name].manager
+
+        def synchronized_start_stimuli(*args, **kwargs):
+            epoch = protocol_object.num_epochs_completed
+            try:
+                self.barrier.wait()
+            except threading.BrokenBarrierError:
+                # Another rig failed, finished early or timed out, or the run was stopped
+                self.clients[rig_name].stop_run()
+                return
+            delay = self.epoch_start_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            output = start_stimuli(*args, **kwargs)
+            manager.request_ack(token=[rig_name, epoch])
+            return output
+
+        protocol_object.start_stimuli = synchronized_start_stimuli
+
+    def start_run(self, protocol_objects, data_objects, save_metadata_flag=True):
+        """
+        Run the protocols on all rigs concurrently.
+
+        protocol_objects: dict of rig name -> protocol object. Each rig needs its own protocol object
+        data_objects: dict of rig name -> data object
+        """
+        num_epochs = {rig_name: int(p.run_parameters['num_epochs']) for rig_name, p in protocol_objects.items()}
+        assert len(set(num_epochs.values())) == 1, 'All rigs must run the same number of epochs: {}'.format(num_epochs)
+
+        self.acks = {rig_name: [] for rig_name in self.rig_names}
+        self.barrier = threading.Barrier(len(self.rig_names), action=self._set_epoch_start_time, timeout=self.barrier_timeout)
+        for rig_name in self.rig_names:
+            self._synchronize(rig_name, protocol_objects[rig_name])
+
+        def run_rig(rig_name):
+            try:
+                self.clients[rig_name].start_run(protocol_objects[rig_name], data_objects[rig_name], save_metadata_flag=save_metadata_flag)
+            finally:
+                # However this rig's run ended, release the other rigs rather than leave them waiting at the barrier.
+                # Rigs that completed all epochs are past their last wait, so this does not cut them short.
+                self.barrier.abort()
+                del protocol_objects[rig_name].start_stimuli
+
+        with ThreadPoolExecutor(max_workers=len(self.rig_names)) as executor:
+            futures = {rig_name: executor.submit(run_rig, rig_name) for rig_name in self.rig_names}
+        errors = {rig_name: f.exception() for rig_name, f in futures.items() if f.exception() is not None}
+        if errors:
+            raise RuntimeError('Run failed on rigs: {}'.format(errors))
+
+        return self.wait_for_acks(num_epochs[self.rig_names[0]])
+
+    def wait_for_acks(self, num_epochs, timeout=5.0):
+        """
+        Wait until every rig has acknowledged num_epochs epochs, or timeout (sec).
+
+        Returns dict of rig name -> number of epochs acknowledged.
+        """
+        t0 = time.time()
+        while time.time() - t0 < timeout:
+            for rig_client in self.clients.values():
+                rig_client.manager.process_queue()
+            with self.ack_lock:
+                counts = {rig_name: len(acks) for rig_name, acks in self.acks.items()}
+            if all(count >= num_epochs for count in counts.values()):
+                break
+            time.sleep(0.01)
+        else:
+            print('Timed out waiting for acknowledgments: {}'.format(counts))
+        return counts
+
+    def stop_run(self):
+        for rig_client in self.clients.values():
+            rig_client.stop_run()
+        if self.barrier is not None:
+            self.barrier.abort()
+
+    def close(self):
+        for rig_client in self.clients.values():
+            rig_client.close()
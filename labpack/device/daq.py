@@ -45,6 +45,20 @@ class DAQonServer(daq.DAQonServer):
         if self.manager is not None:
             self.manager.daq_stream_with_timing(**kwargs)
 
+    def set_digital_pattern(self, multicall=None, **kwargs):
+        if multicall is not None and isinstance(multicall, MyMultiCall):
+            multicall.daq_set_digital_pattern(**kwargs)
+            return multicall
+        if self.manager is not None:
+            self.manager.daq_set_digital_pattern(**kwargs)
+
+    def digital_pulse_train(self, multicall=None, **kwargs):
+        if multicall is not None and isinstance(multicall, MyMultiCall):
+            multicall.daq_digital_pulse_train(**kwargs)
+            return multicall
+        if self.manager is not None:
+            self.manager.daq_digital_pulse_train(**kwargs)
+
 
 # %% National instruments USB daqs
 class NIUSB6001(daq.DAQ):
@@ -92,6 +106,65 @@ class NIUSB6210(daq.DAQ):
 
 # %% LabJack
 
+# Bit offsets of the digital ports in the DIO_* bitmask registers: DIO0-7 = FIO0-7, DIO8-15 = EIO0-7,
+# DIO16-19 = CIO0-3, DIO20-22 = MIO0-2
+DIO_PORT_OFFSETS = {'FIO_STATE': 0, 'EIO_STATE': 8, 'CIO_STATE': 16}
+DIO_LINE_OFFSETS = {'FIO': 0, 'EIO': 8, 'CIO': 16, 'MIO': 20, 'DIO': 0}
+DIO_ALL_MASK = 0x7FFFFF
+
+def get_dio_index(channel):
+    """
+    DIO index of a digital line name, e.g. 'FIO4' -> 4, 'EIO0' -> 8
+    """
+    prefix, line = channel[:3], channel[3:]
+    assert prefix in DIO_LINE_OFFSETS and line.isdigit(), 'Not a digital line: {}'.format(channel)
+    return DIO_LINE_OFFSETS[prefix] + int(line)
+
+def get_dio_port(channels):
+    """
+    Name of the 8-bit STATE register for stream out that holds all of channels.
+    """
+    ports = {name for name, offset in DIO_PORT_OFFSETS.items() for ch in channels if 0 <= get_dio_index(ch) - offset < 8}
+    assert len(ports) == 1, 'All channels must be on the same port (FIO, EIO or CIO): {}'.format(channels)
+    return ports.pop()
+
+def get_dio_bitmask(channels, value=1):
+    """
+    Returns (mask, state) bitmasks for the DIO_* registers.
+
+    channels: list of digital line names
+    value: 0/1 for all channels, or list of 0/1 with one per channel
+    """
+    if not isinstance(value, (list, tuple, np.ndarray)):
+        value = [value] * len(channels)
+    assert len(value) == len(channels)
+    mask = 0
+    state = 0
+    for ch, v in zip(channels, value):
+        bit = 1 << get_dio_index(ch)
+        mask |= bit
+        if v:
+            state |= bit
+    return mask, state
+
+def get_pulse_train_states(n_channels, freq=1, pulse_width=0.01, delay=0, scanRate=10000):
+    """
+    One period of pulse trains on n_channels, sampled at scanRate, as (samples x channels) array of 0/1.
+    freq, pulse_width and delay can be one for all channels or lists with one per channel. They are rounded
+    to whole samples, and each channel's period must divide the longest one.
+    """
+    freq, pulse_width, delay = [np.broadcast_to(np.asarray(p, dtype=float), (n_channels,)) for p in (freq, pulse_width, delay)]
+    # Work in whole samples, so float rounding can't move an edge by a sample
+    period = np.round(scanRate / freq).astype(int)
+    width = np.round(pulse_width * scanRate).astype(int)
+    offset = np.round(delay * scanRate).astype(int)
+
+    n_samples = int(period.max())
+    assert np.all(n_samples % period == 0), 'Pulse train periods {} (samples) must all divide the longest, so the waveform loops seamlessly'.format(period.tolist())
+
+    n = np.arange(n_samples)[:, np.newaxis]
+    return (np.mod(n - offset, period) < width).astype(int)
+
 class LabJackTSeries(daq.DAQ):
     def __init__(self, dev=None, trigger_channel=['FIO4'], init_device=True):
         super().__init__()  # call the parent class init method
@@ -99,6 +172,8 @@ class LabJackTSeries(daq.DAQ):
         self.trigger_channel = trigger_channel
 
         self.stream_thread = None
+        self.stream_output_channel = None
+        self.stream_digital_channels = []
 
         self.init_device()
 
@@ -156,16 +231,16 @@ class LabJackTSeries(daq.DAQ):
         if not isinstance(output_channel, list):
             output_channel = [output_channel]
 
-        write_states = np.ones(len(output_channel), dtype=int)
+        # All channels change in one DIO_STATE write, so multi-line edges are simultaneous
         if initial_delay > 0:
             time.sleep(initial_delay)
         if low_time > 0:
-            self.write(output_channel, (write_states*0).tolist())
+            self.set_digital_pattern(0, output_channel=output_channel)
             time.sleep(low_time)
         if high_time > 0:
-            self.write(output_channel, (write_states*1).tolist())
+            self.set_digital_pattern(1, output_channel=output_channel)
             time.sleep(high_time)
-        self.write(output_channel, (write_states*0).tolist())
+        self.set_digital_pattern(0, output_channel=output_channel)
 
     def set_digital_state(self, value=[1], output_channel=['FIO6']):
         if not isinstance(output_channel, list):
@@ -176,7 +251,19 @@ class LabJackTSeries(daq.DAQ):
 
         assert len(value) == len(output_channel)
 
-        self.write(output_channel, value)
+        self.set_digital_pattern(value, output_channel=output_channel)
+
+    def set_digital_pattern(self, value, output_channel=['FIO4']):
+        """
+        Set several digital lines as outputs and write their states in a single transaction, using the
+        DIO_INHIBIT / DIO_DIRECTION / DIO_STATE bitmask registers.
+
+        value: 0/1 for all channels, or list of 0/1 with one per channel
+        output_channel: (list of str) digital line names, e.g. ['FIO4', 'FIO5', 'EIO0']
+        """
+        mask, state = get_dio_bitmask(output_channel, value)
+        ljm.eWriteNames(self.handle, 3, ["DIO_INHIBIT", "DIO_DIRECTION", "DIO_STATE"],
+                        [DIO_ALL_MASK & ~mask, mask, state])
 
     def analog_output_step(self, output_channel='DAC0', pre_time=0.5, step_time=1, tail_time=0.5, step_amp=0.5, dt=0.01):
         """
@@ -244,7 +331,10 @@ class LabJackTSeries(daq.DAQ):
 
     def stop_stream(self):
         ljm.eStreamStop(self.handle)
-        ljm.eWriteName(self.handle, self.stream_output_channel, 0)
+        if self.stream_output_channel in DIO_PORT_OFFSETS:
+            self.set_digital_pattern(0, output_channel=self.stream_digital_channels)
+        else:
+            ljm.eWriteName(self.handle, self.stream_output_channel, 0)
 
     def stream_with_timing(self, scanListNames=["STREAM_OUT0"], scanRate=5000, scansPerRead=1000, pre_time=0.5, stim_time=1):
         def timing_helper():
@@ -310,6 +400,56 @@ class LabJackTSeries(daq.DAQ):
         waveform[0:int(scanRate*pulse_width)] = amp
         self.analog_periodic_output(output_channel=output_channel, pre_time=pre_time, stim_time=stim_time, waveform=waveform, scanRate=scanRate, scansPerRead=scansPerRead)
 
+    def setup_digital_stream_out(self, output_channel=['FIO4'], states=[0], streamOutIndex=0, scanRate=5000):
+        """
+        Setup periodic stream out of a precomputed sequence of digital states, clocked by the device.
+        All channels must be on the same 8-bit port (FIO, EIO or CIO).
+
+        output_channel: (list of str) digital line names, e.g. ['FIO4', 'FIO5', 'FIO6']
+        states: (2D array, samples x channels) of 0/1, or (1D array) of bitmasks over output_channel, bit i for output_channel[i]
+        scanRate: (Hz) sampling rate of states
+        """
+        if not isinstance(output_channel, list):
+            output_channel = [output_channel]
+        port = get_dio_port(output_channel)
+
+        states = np.asarray(states, dtype=int)
+        if states.ndim == 1:
+            states = (states[:, np.newaxis] >> np.arange(len(output_channel))) & 1
+        assert states.shape[1] == len(output_channel), 'states must have one column per channel'
+
+        # Set lines as outputs, low
+        self.set_digital_pattern(0, output_channel=output_channel)
+
+        # Stream out to a port STATE register: lower 8 bits are the states, upper 8 bits the inhibit mask
+        bits = np.array([get_dio_index(ch) - DIO_PORT_OFFSETS[port] for ch in output_channel])
+        mask = int(np.sum(1 << bits))
+        waveform = ((0xFF & ~mask) << 8) | (states << bits).sum(axis=1)
+
+        self.stream_output_channel = port
+        self.stream_digital_channels = output_channel
+        self.setup_periodic_stream_out(output_channel=port, waveform=waveform.tolist(), streamOutIndex=streamOutIndex, scanRate=scanRate)
+
+    def digital_pulse_train(self, output_channel=['FIO4'], pre_time=0.5, stim_time=1, freq=1, pulse_width=0.01, delay=0, scanRate=10000, scansPerRead=1000):
+        """
+        Generate synchronized TTL pulse trains on several digital lines, clocked by the device.
+            stim comes on at pre_time and goes off at pre_time+stim_time
+
+        output_channel: (list of str) digital line names, all on the same port
+        pre_time: (sec) time duration before the stim comes on
+        stim_time: (sec) duration that stim is on
+        freq: (Hz) pulse frequency, one for all channels or list with one per channel. Periods, in whole samples, must divide the longest
+        pulse_width: (sec) duration of pulse, one for all channels or list with one per channel
+        delay: (sec) delay of first pulse from start of period, one for all channels or list with one per channel
+        scanRate: (Hz) sampling rate of waveform. Timing resolution is 1/scanRate
+        scansPerRead: (int) number of samples to read at a time
+        """
+        if not isinstance(output_channel, list):
+            output_channel = [output_channel]
+        states = get_pulse_train_states(len(output_channel), freq=freq, pulse_width=pulse_width, delay=delay, scanRate=scanRate)
+        self.setup_digital_stream_out(output_channel=output_channel, states=states, scanRate=scanRate)
+        self.stream_with_timing(scanListNames=["STREAM_OUT0"], scanRate=scanRate, scansPerRead=scansPerRead, pre_time=pre_time, stim_time=stim_time)
+
     def close(self):
         if self.is_open:
             ljm.close(self.handle)
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless dry run of a protocol, without a server, screens or DAQ.
+
+Generates every epoch's parameters, instantiates the stimuli off-screen and evaluates eval_at at the
+rig's refresh rate, and drives a simulated DAQ. Reports projected run duration, per-epoch setup overhead
+and the worst-case per-frame compute cost.
+
+Usage:
+    python labpack/dry_run.py configs/example_config.yaml labpack/protocol/JohnDoe_protocol.py MovingEllipsoid --rig Laptop
+"""
+import os
+import sys
+import time
+import argparse
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+import numpy as np
+
+from stimpack.device import daq
+from stimpack.visual_stim import stimuli as spv_stimuli
+
+
+# %% Simulated DAQ
+
+class SimulatedDAQ(daq.DAQ):
+    """
+    DAQ that records each call and advances a virtual clock by the time the call would block on a rig,
+    instead of touching hardware or sleeping.
+    """
+    def __init__(self):
+        super().__init__()  # call the parent class init method
+        self.clock = 0.0
+        self.calls = []
+
+    def _log(self, name, duration, **kwargs):
+        self.calls.append({'name': name, 't': self.clock, 'duration': duration, 'kwargs': kwargs})
+        self.clock += duration
+
+    def sleep(self, duration):
+        self.clock += duration
+
+    def send_trigger(self, trigger_duration=0.05, **kwargs):
+        self._log('send_trigger', trigger_duration, **kwargs)
+
+    def output_step(self, low_time=0.001, high_time=0.100, initial_delay=0.00, **kwargs):
+        self._log('output_step', initial_delay + low_time + high_time, **kwargs)
+
+    def stream_with_timing(self, pre_time=0.5, stim_time=1, **kwargs):
+        # Runs in a thread on the rig, so it does not block
+        self._log('stream_with_timing', 0, pre_time=pre_time, stim_time=stim_time, **kwargs)
+
+
+# %% Loading
+
+def load_config(config_path, rig_name=None):
+    with open(config_path, 'r') as ymlfile:
+        cfg = yaml.safe_load(ymlfile)
+    if rig_name is None:
+        rig_name = list(cfg['rig_config'].keys())[0]
+    cfg['current_rig_name'] = rig_name
+    return cfg
+
+def load_module(module_path):
+    module_name = os.path.splitext(os.path.basename(module_path))[0]
+    spec = importlib.util.spec_from_file_location(module_name, module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def get_stim_classes(visual_stim_paths=[]):
+    """
+    Map of stimulus name -> class, from stimpack's stimuli overridden by the labpack visual_stim modules.
+
+    visual_stim_paths: list of module files or directories of modules, as in module_paths.visual_stim
+    """
+    stim_classes = {name: cls for name, cls in vars(spv_stimuli).items() if isinstance(cls, type)}
+    for path in visual_stim_paths:
+        if os.path.isdir(path):
+            module_paths = [os.path.join(path, fn) for fn in sorted(os.listdir(path)) if fn.endswith('.py')]
+        else:
+            module_paths = [path]
+        for module_path in module_paths:
+            module = load_module(module_path)
+            stim_classes.update({name: cls for name, cls in vars(module).items()
+                                 if isinstance(cls, type) and issubclass(cls, spv_stimuli.BaseProgram)})
+    return stim_classes
+
+
+# %% Simulation
+
+_headless_context = None
+
+def get_headless_context():
+    """
+    Standalone (windowless) ModernGL context for this process, shared by all simulated stimuli.
+    Uses the default backend (X11 on Linux), then EGL for machines without a display.
+    Raises if moderngl is missing or no headless OpenGL is available.
+    """
+    global _headless_context
+    if _headless_context is None:
+        import moderngl
+        try:
+            _headless_context = moderngl.create_standalone_context()
+        except Exception:
+            _headless_context = moderngl.create_standalone_context(backend='egl')
+        # Free each simulated stimulus' programs, buffers and textures when it is collected
+        _headless_context.gc_mode = 'auto'
+    return _headless_context
+
+def simulate_stimulus(stim_class, stim_parameters, stim_time, refresh_rate=60):
+    """
+    Instantiate a stimulus off-screen and evaluate it at every frame of stim_time.
+
+    Like stimpack's load_stim, the stimulus is initialized with a GL context, here a headless one,
+    before it is configured.
+
+    Returns (configure_time, frame_times) in seconds.
+    """
+    stim_parameters = {k: v for k, v in stim_parameters.items() if k != 'name'}
+    stim = stim_class(screen=None)
+    stim.initialize(get_headless_context())
+
+    t0 = time.perf_counter()
+    stim.configure(**stim_parameters)
+    configure_time = time.perf_counter() - t0
+
+    n_frames = int(np.ceil(stim_time * refresh_rate))
+    frame_times = np.zeros(n_frames)
+    for f in range(n_frames):
+        t0 = time.perf_counter()
+        stim.eval_at(f / refresh_rate)
+        frame_times[f] = time.perf_counter() - t0
+    return configure_time, frame_times
+
+def dry_run(protocol, stim_classes, refresh_rate=60, daq_device=None):
+    """
+    Simulate every epoch of an initialized protocol.
+
+    protocol: protocol instance with run_parameters and protocol_parameters set
+    stim_classes: map of stimulus name -> class, from get_stim_classes()
+    refresh_rate: (Hz) refresh rate of the rig's screens
+    daq_device: SimulatedDAQ. A new one is made if None
+
+    Returns a dict report.
+    """
+    if daq_device is None:
+        daq_device = SimulatedDAQ()
+
+    if protocol.run_parameters.get('pre_run_time', 0) > 0:
+        daq_device.sleep(protocol.run_parameters['pre_run_time'])
+    if getattr(protocol, 'trigger_on_epoch_run', False):
+        daq_device.send_trigger()
+
+    epochs = []
+    # One error per stimulus name, with the epochs it was skipped in
+    errors = {}
+    skipped_epochs = []
+    for e in range(int(protocol.run_parameters['num_epochs'])):
+        protocol.num_epochs_completed = e
+
+        t0 = time.perf_counter()
+        protocol.get_epoch_parameters()
+        parameter_time = time.perf_counter() - t0
+
+        epoch_protocol_parameters = protocol.epoch_protocol_parameters
+        stim_time = epoch_protocol_parameters.get('stim_time', 0)
+        stim_parameters = protocol.epoch_stim_parameters
+        if isinstance(stim_parameters, dict):
+            stim_parameters = [stim_parameters]
+
+        configure_time = 0
+        frame_times = np.zeros(int(np.ceil(stim_time * refresh_rate)))
+        n_simulated = 0
+        for sp in stim_parameters:
+            if sp['name'] not in stim_classes:
+                errors.setdefault(sp['name'], {'message': 'unknown stimulus {}'.format(sp['name']), 'epochs': []})['epochs'].append(e)
+                continue
+            try:
+                c_time, f_times = simulate_stimulus(stim_classes[sp['name']], sp, stim_time, refresh_rate=refresh_rate)
+            except Exception as err:
+                # e.g. no headless OpenGL on this machine
+                errors.setdefault(sp['name'], {'message': '{} could not be simulated off-screen: {!r}'.format(sp['name'], err), 'epochs': []})['epochs'].append(e)
+                continue
+            n_simulated += 1
+            configure_time += c_time
+            frame_times[:len(f_times)] += f_times
+        if n_simulated < len(stim_parameters):
+            skipped_epochs.append(e)
+        # Frame cost is unknown, not zero, if no stimulus in the epoch could be simulated
+        simulated = n_simulated > 0 and frame_times.size > 0
+
+        if getattr(protocol, 'trigger_on_epoch', False):
+            daq_device.send_trigger()
+        setup_time = parameter_time + configure_time
+        daq_device.sleep(setup_time)
+        # Slow frames are dropped on the rig, they do not stretch the epoch
+        daq_device.sleep(epoch_protocol_parameters.get('pre_time', 0) + stim_time + epoch_protocol_parameters.get('tail_time', 0))
+
+        epochs.append({'setup_time': setup_time,
+                       'stim_time': stim_time,
+                       'max_frame_time': float(frame_times.max()) if simulated else None,
+                       'mean_frame_time': float(frame_times.mean()) if simulated else None,
+                       'frames_over_budget': int(np.count_nonzero(frame_times > 1 / refresh_rate))})
+
+    if protocol.run_parameters.get('post_run_time', 0) > 0:
+        daq_device.sleep(protocol.run_parameters['post_run_time'])
+
+    setup_times = np.array([ep['setup_time'] for ep in epochs])
+    max_frame_times = [ep['max_frame_time'] for ep in epochs if ep['max_frame_time'] is not None]
+    return {'protocol': type(protocol).__name__,
+            'num_epochs': len(epochs),
+            'projected_run_time': daq_device.clock,
+            'mean_setup_time': float(setup_times.mean()) if setup_times.size else 0.0,
+            'max_setup_time': float(setup_times.max()) if setup_times.size else 0.0,
+            'max_frame_time': max(max_frame_times, default=None),
+            'frames_over_budget': sum([ep['frames_over_budget'] for ep in epochs]),
+            'frame_budget': 1 / refresh_rate,
+            'daq_calls': len(daq_device.calls),
+            'skipped_epochs': skipped_epochs,
+            'epochs': epochs,
+            'errors': ['{} (epochs: {})'.format(err['message'], _format_epochs(err['epochs'])) for err in errors.values()]}
+
+def _format_epochs(epochs, max_listed=10):
+    if len(epochs) > max_listed:
+        return '{}, ... {} in total'.format(', '.join(str(e) for e in epochs[:max_listed]), len(epochs))
+    return ', '.join(str(e) for e in epochs)
+
+def dry_run_protocol(config_path, protocol_module_path, protocol_name, preset_name=None, rig_name=None,
+                     visual_stim_paths=None, refresh_rate=60, seed=None):
+    """
+    Load a protocol from its module and dry run it, optionally with one of its parameter presets.
+
+    visual_stim_paths: visual stim modules. Defaults to module_paths.visual_stim in the config
+    seed: seed for numpy's global random state, for reproducible randomized protocols
+    """
+    if seed is not None:
+        np.random.seed(seed)
+    cfg = load_config(config_path, rig_name=rig_name)
+    if visual_stim_paths is None:
+        visual_stim_paths = cfg.get('module_paths', {}).get('visual_stim', [])
+        if not isinstance(visual_stim_paths, list):
+            visual_stim_paths = [visual_stim_paths]
+
+    protocol = getattr(load_module(protocol_module_path), protocol_name)(cfg)
+    if preset_name is not None:
+        protocol.select_protocol_preset(name=preset_name)
+
+    report = dry_run(protocol, get_stim_classes(visual_stim_paths), refresh_rate=refresh_rate)
+    report['preset'] = preset_name
+    return report
+
+def _dry_run_job(kwargs):
+    try:
+        return dry_run_protocol(**kwargs)
+    except Exception as err:
+        return {'protocol': kwargs.get('protocol_name'), 'preset': kwargs.get('preset_name'), 'errors': [repr(err)]}
+
+def dry_run_batch(jobs, max_workers=None):
+    """
+    Dry run many protocol / preset combinations in a process pool.
+
+    jobs: list of dicts of kwargs for dry_run_protocol
+    max_workers: number of processes. Defaults to the number of cores
+
+    Returns the reports in the same order as jobs.
+    """
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_dry_run_job, jobs))
+
+def print_report(report):
+    print('{} (preset: {})'.format(report['protocol'], report.get('preset')))
+    if 'projected_run_time' in report:
+        print('    epochs: {}, projected run time: {:.1f} sec'.format(report['num_epochs'], report['projected_run_time']))
+        print('    epoch setup: mean {:.1f} ms, max {:.1f} ms'.format(1e3*report['mean_setup_time'], 1e3*report['max_setup_time']))
+        if report['max_frame_time'] is None:
+            print('    worst frame: unknown, no stimulus could be simulated')
+        else:
+            print('    worst frame: {:.2f} ms of {:.2f} ms budget, {} frames over budget'.format(1e3*report['max_frame_time'], 1e3*report['frame_budget'], report['frames_over_budget']))
+        if report['skipped_epochs']:
+            print('    {} of {} epochs not fully simulated'.format(len(report['skipped_epochs']), report['num_epochs']))
+    for err in report['errors']:
+        print('    ' + err)
+
+def main():
+    parser = argparse.ArgumentParser(description='Dry run stimpack protocols without a rig.')
+    parser.add_argument('config', help='path to config yaml')
+    parser.add_argument('protocol_module', help='path to protocol module')
+    parser.add_argument('protocol_names', nargs='+', help='protocol class names')
+    parser.add_argument('--presets', nargs='*', default=[None], help='parameter preset names')
+    parser.add_argument('--rig', default=None, help='rig name in rig_config')
+    parser.add_argument('--refresh_rate', type=float, default=60, help='(Hz) screen refresh rate')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    args = parser.parse_args()
+
+    jobs = [{'config_path': args.config, 'protocol_module_path': args.protocol_module, 'protocol_name': name,
+             'preset_name': preset, 'rig_name': args.rig, 'refresh_rate': args.refresh_rate, 'seed': args.seed}
+            for name in args.protocol_names for preset in args.presets]
+    reports = dry_run_batch(jobs, max_workers=args.workers) if len(jobs) > 1 else [_dry_run_job(jobs[0])]
+    for report in reports:
+        print_report(report)
+    return 1 if any(report['errors'] for report in reports) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
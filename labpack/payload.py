@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact encoding of NumPy arrays in RPC requests.
+
+The stimpack RPC link sends each request list as a line of JSON, so a NumPy array would otherwise go
+as a nested list of numbers in decimal text. encode_arrays replaces each large array with a small dict
+holding its raw buffer (optionally zlib-compressed) as base64, with its dtype and shape. The dict is
+plain JSON, so it passes unchanged through the server to the screens; decode_arrays turns it back into
+an array with np.frombuffer, without copying the decoded buffer.
+
+The client only encodes once the server has answered the "binary_payloads_hello" request, so servers
+that don't know about this encoding, and small requests, are unaffected. Only requests that decode are
+encoded: functions on the server's root node (all decoded by server/base_server.py), and load_stim
+requests for the stimuli in DECODING_STIMULI, whose configure methods are wrapped with decode_payload.
+Arrays in any other request are sent as lists.
+
+Only NumPy arrays are encoded, so protocols should build large parameters (trajectories, per-face
+colors) with np.asarray rather than as lists.
+"""
+import zlib
+import base64
+import functools
+import numpy as np
+
+PAYLOAD_VERSION = 1
+ARRAY_KEY = '__ndarray__'
+
+# Stimuli whose configure method decodes payloads. Keep in step with @decode_payload in
+# labpack/visual_stim/example/stimuli.py; other stimuli can be added with the client's
+# binary_payloads_stimuli server option.
+DECODING_STIMULI = frozenset({'MovingEllipsoid'})
+
+
+def encode_array(array, compress=False):
+    array = np.ascontiguousarray(array)
+    buffer = array.tobytes()
+    if compress:
+        buffer = zlib.compress(buffer, 1)
+    return {ARRAY_KEY: base64.b64encode(buffer).decode('ascii'),
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+            'compressed': compress}
+
+def decode_array(encoded):
+    """
+    Returns a read-only array backed by the decoded buffer.
+    """
+    buffer = base64.b64decode(encoded[ARRAY_KEY])
+    if encoded.get('compressed', False):
+        buffer = zlib.decompress(buffer)
+    return np.frombuffer(buffer, dtype=np.dtype(encoded['dtype'])).reshape(encoded['shape'])
+
+def is_encoded_array(value):
+    return isinstance(value, dict) and ARRAY_KEY in value
+
+def encode_arrays(value, min_bytes=4096, compress=False):
+    """
+    Recursively encode NumPy arrays of at least min_bytes in value (lists, tuples and dicts).
+    Smaller arrays are converted to lists, as JSON needs.
+    """
+    if isinstance(value, np.ndarray):
+        if value.nbytes >= min_bytes and value.dtype.kind in 'biuf':
+            return encode_array(value, compress=compress)
+        return value.tolist()
+    elif isinstance(value, dict):
+        return {k: encode_arrays(v, min_bytes=min_bytes, compress=compress) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return type(value)(encode_arrays(v, min_bytes=min_bytes, compress=compress) for v in value)
+    return value
+
+def decode_arrays(value):
+    """
+    Recursively decode arrays encoded by encode_arrays in value.
+    """
+    if is_encoded_array(value):
+        return decode_array(value)
+    elif isinstance(value, dict):
+        return {k: decode_arrays(v) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return type(value)(decode_arrays(v) for v in value)
+    return value
+
+def decodes_payload(request, stimuli=DECODING_STIMULI):
+    """
+    Whether the receiver of request decodes binary payloads: a function on the server's root node, or
+    load_stim for one of stimuli.
+    """
+    if request.get('target', 'root') == 'root':
+        return True
+    return request.get('name') == 'load_stim' and request.get('kwargs', {}).get('name') in stimuli
+
+def encode_request_list(request_list, min_bytes=4096, compress=False, stimuli=DECODING_STIMULI):
+    """
+    Encode arrays in the requests whose receivers decode them (see decodes_payload). Arrays in other
+    requests are converted to lists.
+
+    stimuli: names of stimuli whose configure method decodes payloads
+    """
+    encoded = []
+    for request in request_list:
+        if isinstance(request, dict) and ('args' in request or 'kwargs' in request):
+            request = dict(request)
+            # An infinite min_bytes converts every array to a list
+            request_min_bytes = min_bytes if decodes_payload(request, stimuli=stimuli) else np.inf
+            request['args'] = encode_arrays(list(request.get('args', [])), min_bytes=request_min_bytes, compress=compress)
+            request['kwargs'] = encode_arrays(request.get('kwargs', {}), min_bytes=request_min_bytes, compress=compress)
+        encoded.append(request)
+    return encoded
+
+def decode_payload(function):
+    """
+    Decorator that decodes encoded arrays in a function's arguments, e.g. a stimulus' configure method
+    or a function registered on the server.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return function(*decode_arrays(list(args)), **decode_arrays(kwargs))
+    return wrapper
@@ -5,6 +5,8 @@
 @author: mhturner
 """
 
+import numpy as np
+
 from labpack.protocol import base_protocol
 
 
@@ -126,4 +128,66 @@ class MovingEllipsoid(BaseProtocol):
                 'all_combinations': True,
                 'randomize_order': True}
 
+# %%
+
+class EllipsoidRandomWalk(BaseProtocol):
+    """
+    Ellipsoid following a random walk, sampled at update_rate.
+
+    The trajectories are sent as NumPy arrays of (time, value) pairs, several kB each, so on rigs with
+    binary_payloads set they go as binary payloads rather than as lists of numbers (see labpack.payload).
+    The saved stim parameters only hold a truncated repr of the arrays: each epoch's walk can be
+    regenerated from its trajectory_seed.
+    """
+    def __init__(self, cfg):
+        super().__init__(cfg)
+
+        self.run_parameters = self.get_run_parameter_defaults()
+        self.protocol_parameters = self.get_protocol_parameter_defaults()
+
+    def get_epoch_parameters(self):
+        super().get_epoch_parameters()
+
+        stim_time = self.epoch_protocol_parameters['stim_time']
+        update_rate = self.epoch_protocol_parameters['update_rate']
+        self.epoch_protocol_parameters['trajectory_seed'] = self.num_epochs_completed
+
+        rng = np.random.default_rng(self.epoch_protocol_parameters['trajectory_seed'])
+        t = np.arange(0, stim_time, 1/update_rate)
+        step = self.epoch_protocol_parameters['speed'] * np.sqrt(1/update_rate)
+        walk = np.cumsum(rng.normal(scale=step, size=(t.size, 3)), axis=0)
+        center = np.asarray(self.epoch_protocol_parameters['center'])
+
+        trajectories = [{'name': 'TVPairs',
+                         'tv_pairs': np.column_stack((t, center[i] + walk[:, i])),
+                         'kind': 'linear'} for i in range(3)]
+
+        self.epoch_stim_parameters = {'name': 'MovingEllipsoid',
+                                      'x_length': self.epoch_protocol_parameters['dimensions'][0],
+                                      'y_length': self.epoch_protocol_parameters['dimensions'][1],
+                                      'z_length': self.epoch_protocol_parameters['dimensions'][2],
+                                      'color': self.epoch_protocol_parameters['color'],
+                                      'x': trajectories[0],
+                                      'y': trajectories[1],
+                                      'z': trajectories[2],
+                                      'n_subdivisions': 6}
+
+    def get_protocol_parameter_defaults(self):
+        return {'pre_time': 0.5,
+                'stim_time': 10.0,
+                'tail_time': 0.5,
+
+                'update_rate': 60.0,  # Hz
+                'speed': 1.0,  # m/sqrt(sec), scale of the random walk
+                'center': (0, 5, 0),
+                'dimensions': (2,1,1),
+                'color': None,
+                }
+
+    def get_run_parameter_defaults(self):
+        return {'num_epochs': 5,
+                'idle_color': 0.5,
+                'all_combinations': True,
+                'randomize_order': True}
+
 # %%
\ No newline at end of file
@@ -12,6 +12,31 @@ Protocol parent class. Override any methods in here in the user protocol subclas
 """
 from stimpack.experiment import protocol
 
+from labpack.visual_stim.example import util as labpack_util
+
 class BaseProtocol(protocol.BaseProtocol):
     def __init__(self, cfg):
         super().__init__(cfg)  # call the parent class init method
+
+    def prepare_run(self, manager, *args, **kwargs):
+        super().prepare_run(manager, *args, **kwargs)
+        # Set run_parameters['preload_resources'] = True to load the resources named in the presets before the run
+        if self.run_parameters.get('preload_resources', False):
+            self.preload_resources(manager)
+
+    def get_resource_names(self):
+        """
+        Names of the labpack resources used by this protocol's parameters and parameter presets.
+        """
+        return labpack_util.find_resource_names([self.protocol_parameters, getattr(self, 'parameter_presets', {})])
+
+    def preload_resources(self, manager):
+        """
+        Have the server write decoded copies of this protocol's image and movie resources, and read all
+        of its resources into the OS page cache, so the screens load them from memory.
+        """
+        if manager is None:
+            return
+        resource_names = self.get_resource_names()
+        if len(resource_names) > 0:
+            manager.preload_resources(resource_names=resource_names)
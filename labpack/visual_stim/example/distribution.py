@@ -1,3 +1,5 @@
+import os
+import json
 import numpy as np
 from stimpack.visual_stim import distribution as spv_distribution
 
@@ -22,3 +24,47 @@ class SparseBinary(spv_distribution.Distribution):
         return rand_values
 
 
+
+
+def make_as_distribution(distribution_data):
+    """
+    Distribution object from a distribution dict, looking in labpack first and then in stimpack.
+    Only Distribution subclasses are made, since the name comes over RPC.
+    """
+    if isinstance(distribution_data, dict):
+        distribution_class = globals().get(distribution_data.get('name'))
+        if isinstance(distribution_class, type) and issubclass(distribution_class, spv_distribution.Distribution):
+            kwargs = {k: v for k, v in distribution_data.items() if k != 'name'}
+            return distribution_class(**kwargs)
+    return spv_distribution.make_as_distribution(distribution_data)
+
+def render_noise_movie(file_path, distribution_data, n_frames, frame_shape, start_seed=0, update_rate=60.0):
+    """
+    Render a noise movie ahead of time into a memory-mapped uint8 .npy file, for NoiseMovieOnSphericalPatch.
+
+    Frame k is drawn with seed start_seed + k, as stimpack's random grid stimuli seed each update, and
+    scaled to 0-255 the same way, so the file is also the exact record of what was shown. A .json file
+    next to it records the parameters.
+
+    :param file_path: .npy file to write
+    :param distribution_data: dict with name and kwargs of the distribution, e.g. {'name': 'SparseBinary', 'sparseness': 0.5}
+    :param n_frames: number of noise frames (stimulus duration * update_rate)
+    :param frame_shape: (n_patches_height, n_patches_width), or (n_patches_height, n_patches_width, 3) for RGB
+    :param start_seed: seed of the first frame
+    :param update_rate: Hz, rate at which the frames are played back
+    """
+    noise_distribution = make_as_distribution(distribution_data)
+    frame_shape = tuple(frame_shape)
+
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+    movie = np.lib.format.open_memmap(file_path, mode='w+', dtype=np.uint8, shape=(n_frames,) + frame_shape)
+    for k in range(n_frames):
+        np.random.seed(start_seed + k)
+        movie[k] = (255*noise_distribution.get_random_values(frame_shape)).astype(np.uint8)
+    movie.flush()
+    del movie
+
+    with open(os.path.splitext(file_path)[0] + '.json', 'w') as f:
+        json.dump({'distribution_data': distribution_data, 'n_frames': n_frames, 'frame_shape': list(frame_shape),
+                   'start_seed': start_seed, 'update_rate': update_rate}, f)
+    return file_path
@@ -5,16 +5,19 @@ import numpy as np
 
 from stimpack.visual_stim import shapes as spv_shapes
 from stimpack.visual_stim import stimuli as spv_stimuli
-from stimpack.visual_stim.stimuli import BaseProgram
 from stimpack.visual_stim.trajectory import make_as_trajectory, return_for_time_t
 from stimpack.visual_stim.distribution import make_as_distribution
 
 from labpack.visual_stim.example.shapes import GlIcosphere
+from labpack.visual_stim.profiler import ProfiledProgram
+from labpack.payload import decode_payload
 
-class MovingEllipsoid(BaseProgram):
+class MovingEllipsoid(ProfiledProgram):
     def __init__(self, screen):
         super().__init__(screen=screen, num_tri=1000)
 
+    # Listed in labpack.payload.DECODING_STIMULI, so the client sends it binary payloads
+    @decode_payload
     def configure(self, x_length=1, y_length=1, z_length=1, color=(1, 1, 1, 1), x=0, y=0, z=0, yaw=0, pitch=0, roll=0, n_subdivisions=6):
         """
         Stimulus consisting of a rectangular patch on the surface of a sphere. Patch is rectangular in spherical coordinates.
@@ -63,3 +66,38 @@ class MovingEllipsoid(BaseProgram):
         # if self.color is not None: #TODO: fix coloring
         #     self.stim_object.set_color(util.get_rgba(color))
 
+
+
+class NoiseMovieOnSphericalPatch(ProfiledProgram, spv_stimuli.TexturedSphericalPatch):
+    """
+    Plays a noise movie pre-rendered by labpack.visual_stim.example.distribution.render_noise_movie,
+    reading each frame from the memory-mapped file instead of sampling it.
+    """
+    def __init__(self, screen):
+        super().__init__(screen=screen)
+
+    def configure(self, movie_path, update_rate=60.0, start_frame=0,
+                  width=30, height=30, sphere_radius=1, color=[1, 1, 1, 1], theta=0, phi=0, angle=0, n_steps_x=12, n_steps_y=12):
+        """
+        :param movie_path: path to the .npy noise movie on the server
+        :param update_rate: Hz, rate at which movie frames are shown
+        :param start_frame: movie frame shown at t=0
+
+        :other params: see TexturedSphericalPatch
+        """
+        self.movie = np.load(movie_path, mmap_mode='r')
+        self.rgb_texture = self.movie.ndim == 4
+        self.update_rate = update_rate
+        self.start_frame = start_frame
+        self.current_frame = None
+
+        super().configure(width=width, height=height, sphere_radius=sphere_radius, color=color, theta=theta, phi=phi, angle=angle, n_steps_x=n_steps_x, n_steps_y=n_steps_y)
+
+        self.add_texture_gl(np.ascontiguousarray(self.movie[start_frame]), texture_interpolation='NEAREST')
+
+    def eval_at(self, t, subject_position={'x':0, 'y':0, 'z':0, 'theta':0, 'phi':0, 'roll':0}):
+        # Same frame index as the seed in stimpack's random grids. Hold the last frame past the end of the movie
+        frame = min(int(round(self.start_frame + t*self.update_rate)), self.movie.shape[0] - 1)
+        if frame != self.current_frame:
+            self.update_texture_gl(self.movie[frame])
+            self.current_frame = frame
@@ -1,19 +1,174 @@
 import os
+import tempfile
+import threading
+from collections import OrderedDict
 import numpy as np
-import inspect
-import labpack
 from stimpack.visual_stim import util as spv_util
 
+# labpack/resources. Found from this file, since labpack is a namespace package without a __file__
+RESOURCE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'resources')
+
+# Directory for decoded images and movies, e.g. if the resource directory is not writable. Defaults to RESOURCE_DIR.
+# Decoded files always go in a .decoded subdirectory of it, so they can't overwrite a resource
+DECODED_CACHE_DIR_ENV = 'LABPACK_DECODED_CACHE_DIR'
+
 def get_resource_path(resource_name):
-    path_to_resource = os.path.join(inspect.getfile(labpack).split('labpack')[0],
-                                    'labpack',
-                                    'resources',
-                                    resource_name)
+    path_to_resource = os.path.join(RESOURCE_DIR, resource_name)
 
     assert os.path.exists(path_to_resource), 'Resource not found at {}'.format(path_to_resource)
 
     return path_to_resource
 
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp')
+MOVIE_EXTENSIONS = ('.mp4', '.avi', '.mov', '.gif')
+
+class ResourceCache():
+    """
+    Size-bounded LRU cache of loaded resources, keyed by resource name.
+
+    .npy resources are opened as read-only memory maps, so they cost no memory up front and their pages
+    are shared through the OS page cache with every process that maps the same file. Images and movies
+    are decoded once; with cache_decoded=True the decoded array is also saved as a .npy (see
+    get_decoded_path), and memory mapped from then on.
+
+    Each process has its own cache. The screen processes, where stimuli run, share pages only through
+    the files they memory map (see preload_resources).
+    """
+    def __init__(self, max_bytes=2*1024**3):
+        self.max_bytes = max_bytes
+        self.cache = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, resource_name, cache_decoded=True):
+        with self.lock:
+            if resource_name in self.cache:
+                self.cache.move_to_end(resource_name)
+                return self.cache[resource_name]
+
+        resource = load_resource(resource_name, cache_decoded=cache_decoded)
+
+        # Memory maps are backed by the file, not counted against max_bytes
+        nbytes = 0 if isinstance(resource, np.memmap) else resource.nbytes
+        with self.lock:
+            if resource_name not in self.cache and nbytes <= self.max_bytes:
+                self.cache[resource_name] = resource
+                self.nbytes += nbytes
+                self._evict()
+        return resource
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            _, resource = self.cache.popitem(last=False)
+            self.nbytes -= 0 if isinstance(resource, np.memmap) else resource.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.nbytes = 0
+
+resource_cache = ResourceCache()
+
+def load_resource(resource_name, cache_decoded=True):
+    """
+    Load a resource from labpack/resources as a NumPy array, without caching. Use get_resource() instead.
+
+    :param resource_name: file name relative to labpack/resources
+    :param cache_decoded: save decoded images/movies as .npy (see get_decoded_path), to memory map next time
+    """
+    path = get_resource_path(resource_name)
+    ext = os.path.splitext(path)[1].lower()
+
+    if ext == '.npy':
+        return np.load(path, mmap_mode='r')
+    if not cache_decoded:
+        return decode_resource(path)
+
+    decoded_path = get_decoded_path(resource_name)
+    if not (os.path.exists(decoded_path) and os.path.getmtime(decoded_path) >= os.path.getmtime(path)):
+        resource = decode_resource(path)
+        try:
+            save_atomic(decoded_path, resource)
+        except OSError as e:
+            print('Could not cache decoded {} at {}: {}. Set {} to a writable directory.'.format(resource_name, decoded_path, e, DECODED_CACHE_DIR_ENV))
+            return resource
+    return np.load(decoded_path, mmap_mode='r')
+
+def decode_resource(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in IMAGE_EXTENSIONS:
+        from PIL import Image
+        with Image.open(path) as im:
+            return np.asarray(im)
+    elif ext in MOVIE_EXTENSIONS:
+        import imageio
+        return np.stack(imageio.mimread(path, memtest=False))
+    raise ValueError('Unsupported resource type: {}'.format(path))
+
+def get_decoded_path(resource_name):
+    """
+    Where the decoded .npy of an image or movie resource is cached: under .decoded/ in RESOURCE_DIR, or
+    in the directory in the LABPACK_DECODED_CACHE_DIR environment variable if it is set. The full
+    resource name is kept, so foo.png and foo.jpg don't share a file.
+    """
+    cache_dir = os.environ.get(DECODED_CACHE_DIR_ENV) or RESOURCE_DIR
+    return os.path.join(cache_dir, '.decoded', resource_name + '.npy')
+
+def save_atomic(file_path, array):
+    """
+    Save array as .npy through a temporary file in the same directory, so that other processes loading
+    the same resource never see a partly written file.
+    """
+    directory = os.path.dirname(file_path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.npy.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def get_resource(resource_name, cache_decoded=True):
+    """
+    Load a resource from labpack/resources as a NumPy array, through the process-wide LRU cache.
+    Arrays may be read-only memory maps: copy before modifying.
+    """
+    return resource_cache.get(resource_name, cache_decoded=cache_decoded)
+
+def preload_resources(resource_names):
+    """
+    Write decoded .npy files for image and movie resources, and read every resource's file through, so
+    that it is in the OS page cache before the run starts.
+
+    Runs on the server's root process, while the stimuli load resources in the screen processes. So
+    nothing is kept in this process' resource cache: the screens share the preloaded pages through
+    their own memory maps of the same files.
+    """
+    for resource_name in resource_names:
+        resource = load_resource(resource_name, cache_decoded=True)
+        if isinstance(resource, np.memmap):
+            # Touch one byte per page
+            flat = resource.reshape(-1).view(np.uint8)
+            flat[::4096].sum()
+        # A decoded array that could not be saved is dropped here: the screens decode their own
+        del resource
+
+def find_resource_names(parameters):
+    """
+    Resource names in a (nested) dict or list of parameters, e.g. a protocol's parameter presets:
+    any string value naming a file in labpack/resources.
+    """
+    if isinstance(parameters, dict):
+        parameters = list(parameters.values())
+    if isinstance(parameters, (list, tuple)):
+        return sorted(set(name for p in parameters for name in find_resource_names(p)))
+    if isinstance(parameters, str):
+        is_resource = parameters and not os.path.isabs(parameters) and os.path.isfile(os.path.join(RESOURCE_DIR, parameters))
+        return [parameters] if is_resource else []
+    return []
+
 def rot1_scale_rot2(pts, yaw1, pitch1, roll1, scale_x, scale_y, scale_z, yaw2, pitch2, roll2):
     A = spv_util.rot_mat(yaw2, pitch2, roll2) @ np.diag([scale_x, scale_y, scale_z]) @ spv_util.rot_mat(yaw1, pitch1, roll1)
     return A @ pts
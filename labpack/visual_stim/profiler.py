@@ -0,0 +1,201 @@
+import os
+import glob
+import time
+import numpy as np
+
+from stimpack.visual_stim.stimuli import BaseProgram
+
+# Set by the server before the screens are launched, so that the display processes inherit them.
+PROFILE_DIR_ENV = 'LABPACK_PROFILE_DIR'
+PROFILE_REFRESH_RATE_ENV = 'LABPACK_PROFILE_REFRESH_RATE'
+
+RECORD_DTYPE = np.dtype([('seq', 'i8'),             # running record count, 0 = empty slot
+                         ('frame', 'i8'),           # frame index within the display process
+                         ('t', 'f8'),               # perf_counter time at start of paint_at
+                         ('frame_interval', 'f8'),  # sec since the start of the previous frame
+                         ('missed_vsyncs', 'i4'),   # vsyncs missed before this frame
+                         ('eval_time', 'f8'),       # sec spent in eval_at
+                         ('upload_time', 'f8'),     # sec spent in paint_at after eval_at (vertex upload + draw)
+                         ('stim', 'U32')])
+
+
+class FrameProfiler():
+    """
+    Ring buffer of per-frame, per-stimulus render timings.
+
+    One record is written each time a profiled stimulus paints. Every stimulus in a frame is painted with
+    the same stimulus time, so a new frame starts when the stimulus time changes; the interval between
+    frame starts is used to count missed vsyncs, which covers the time spent in the buffer swap.
+
+    The first frame of each epoch (stimulus time restarting, or more than max_gap_periods since the last
+    frame) starts a new run of intervals and is not counted as missing vsyncs.
+
+    If path is given, the buffer is a memory-mapped .npy file, so that the server's root node can read the
+    timings written by the display processes.
+    """
+    def __init__(self, capacity=100000, refresh_rate=60, path=None, max_gap_periods=30):
+        self.capacity = capacity
+        self.refresh_rate = refresh_rate
+        # Longer gaps between frames are pauses between epochs, not dropped frames
+        self.max_gap_periods = max_gap_periods
+        self.path = path
+
+        if path is None:
+            self.records = np.zeros(capacity, dtype=RECORD_DTYPE)
+        else:
+            self.records = np.lib.format.open_memmap(path, mode='w+', dtype=RECORD_DTYPE, shape=(capacity,))
+
+        self.reset()
+
+    def reset(self):
+        self.records[:] = np.zeros(1, dtype=RECORD_DTYPE)
+        self.seq = 0
+        self.frame = -1
+        self.frame_start = None
+        self.last_stim_time = None
+        self.frame_interval = np.nan
+        self.missed_vsyncs = 0
+
+    def begin_paint(self, stim_time):
+        """
+        Call at the start of each stimulus paint. Returns the timestamp to pass to record().
+
+        stim_time: (sec) stimulus time being painted. A new frame starts when it changes. When it goes
+                   backwards, a new epoch has started and the gap since the last frame (tail, idle and pre
+                   time) is not counted as a frame interval.
+        """
+        now = time.perf_counter()
+        period = 1.0 / self.refresh_rate
+        if stim_time != self.last_stim_time:
+            restarted = self.last_stim_time is not None and stim_time < self.last_stim_time
+            if self.frame_start is None or restarted or (now - self.frame_start) > self.max_gap_periods * period:
+                # First frame of a run of frames: nothing to compare to
+                self.frame_interval = np.nan
+                self.missed_vsyncs = 0
+            else:
+                self.frame_interval = now - self.frame_start
+                self.missed_vsyncs = max(int(round(self.frame_interval / period)) - 1, 0)
+            self.frame += 1
+            self.frame_start = now
+            self.last_stim_time = stim_time
+        return now
+
+    def record(self, stim, t_start, eval_time, upload_time):
+        self.seq += 1
+        ind = (self.seq - 1) % self.capacity
+        # Missed vsyncs are counted once per frame, on the first stimulus painted in it
+        first_in_frame = t_start == self.frame_start
+        self.records[ind] = (self.seq, self.frame, t_start,
+                             self.frame_interval if first_in_frame else np.nan,
+                             self.missed_vsyncs if first_in_frame else 0,
+                             eval_time, upload_time, stim[:32])
+
+    def get_records(self):
+        """
+        Returns valid records in the order they were written.
+        """
+        records = self.records[self.records['seq'] > 0]
+        return records[np.argsort(records['seq'])]
+
+    def get_summary(self):
+        return summarize(self.get_records(), self.refresh_rate)
+
+    def dump(self, file_path):
+        np.save(file_path, self.get_records())
+        return file_path
+
+    def flush(self):
+        if isinstance(self.records, np.memmap):
+            self.records.flush()
+
+
+def summarize(records, refresh_rate=60):
+    """
+    Summarize profiler records into a dict that can be sent back over RPC.
+
+    records: structured array with RECORD_DTYPE
+    refresh_rate: (Hz) nominal refresh rate of the screen
+    """
+    intervals = records['frame_interval'][~np.isnan(records['frame_interval'])]
+    summary = {'n_frames': int(np.unique(records['frame']).size),
+               'missed_vsyncs': int(records['missed_vsyncs'].sum()),
+               'dropped_frames': int(np.count_nonzero(records['missed_vsyncs'])),
+               'frame_budget_ms': 1e3 / refresh_rate,
+               'frame_interval_ms': _stats(intervals),
+               'stimuli': {}}
+
+    for stim in np.unique(records['stim']):
+        stim_records = records[records['stim'] == stim]
+        paint_time = stim_records['eval_time'] + stim_records['upload_time']
+        summary['stimuli'][str(stim)] = {'n_frames': int(stim_records.size),
+                                         'eval_ms': _stats(stim_records['eval_time']),
+                                         'upload_ms': _stats(stim_records['upload_time']),
+                                         'over_budget': int(np.count_nonzero(paint_time > 1.0 / refresh_rate))}
+    return summary
+
+def _stats(values):
+    if values.size == 0:
+        return {'mean': None, 'p95': None, 'max': None}
+    values = 1e3 * values
+    return {'mean': float(np.mean(values)), 'p95': float(np.percentile(values, 95)), 'max': float(np.max(values))}
+
+
+def get_profile_paths(profile_dir):
+    return sorted(glob.glob(os.path.join(profile_dir, 'frames_*.npy')))
+
+def load_records(profile_dir):
+    """
+    Load the records written by every display process into profile_dir.
+    """
+    records = {}
+    for path in get_profile_paths(profile_dir):
+        buffer = np.load(path, mmap_mode='r')
+        valid = buffer[buffer['seq'] > 0]
+        records[os.path.basename(path)] = valid[np.argsort(valid['seq'])]
+    return records
+
+
+_profiler = None
+
+def get_profiler():
+    """
+    Returns the profiler for this process, or None if profiling was not enabled on the server.
+    """
+    global _profiler
+    if _profiler is None:
+        profile_dir = os.environ.get(PROFILE_DIR_ENV)
+        if not profile_dir:
+            return None
+        os.makedirs(profile_dir, exist_ok=True)
+        _profiler = FrameProfiler(refresh_rate=float(os.environ.get(PROFILE_REFRESH_RATE_ENV, 60)),
+                                  path=os.path.join(profile_dir, 'frames_{}.npy'.format(os.getpid())))
+    return _profiler
+
+
+class ProfiledProgram(BaseProgram):
+    """
+    BaseProgram that records the time spent in eval_at and in the rest of paint_at (vertex upload and draw)
+    when profiling is enabled on the server. Does nothing extra otherwise.
+    """
+    def paint_at(self, t, *args, **kwargs):
+        profiler = get_profiler()
+        if profiler is None or not kwargs.get('prepare', True):
+            return super().paint_at(t, *args, **kwargs)
+
+        t_start = profiler.begin_paint(stim_time=t)
+        eval_at = self.eval_at
+        eval_time = 0
+
+        def timed_eval_at(*eval_args, **eval_kwargs):
+            nonlocal eval_time
+            t0 = time.perf_counter()
+            eval_at(*eval_args, **eval_kwargs)
+            eval_time = time.perf_counter() - t0
+
+        self.eval_at = timed_eval_at
+        try:
+            super().paint_at(t, *args, **kwargs)
+        finally:
+            del self.eval_at
+        upload_time = time.perf_counter() - t_start - eval_time
+        profiler.record(type(self).__name__, t_start, eval_time, upload_time)
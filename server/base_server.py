@@ -1,9 +1,94 @@
+import os
+import numpy as np
 from stimpack.experiment import server
 
+from labpack import payload
+from labpack.visual_stim import profiler
+from labpack.visual_stim.example import util as labpack_util
+from labpack.visual_stim.example import distribution as labpack_distribution
+
 class BaseServer(server.BaseServer):
-    def __init__(self, host='', port=60629, visual_stim_kwargs={}, loco_class=None, loco_kwargs={}, daq_class=None, daq_kwargs={}):
-        super().__init__(host=host, port=port, 
-                         visual_stim_kwargs=visual_stim_kwargs, 
-                         loco_class=loco_class, loco_kwargs=loco_kwargs, 
+    def __init__(self, host='', port=60629, visual_stim_kwargs={}, loco_class=None, loco_kwargs={}, daq_class=None, daq_kwargs={},
+                 profile_dir=None, profile_refresh_rate=60):
+        '''
+        :param profile_dir: directory for per-frame render timings. None (default) disables profiling.
+                            Stimuli that inherit labpack.visual_stim.profiler.ProfiledProgram write their timings here.
+        :param profile_refresh_rate: (Hz) refresh rate of the screens, used to count missed vsyncs
+        '''
+        # Set before the screens are launched so that the display processes inherit it
+        self.profile_dir = profile_dir
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+            for path in profiler.get_profile_paths(profile_dir):
+                os.remove(path)
+            os.environ[profiler.PROFILE_DIR_ENV] = profile_dir
+            os.environ[profiler.PROFILE_REFRESH_RATE_ENV] = str(profile_refresh_rate)
+        self.profile_refresh_rate = profile_refresh_rate
+
+        super().__init__(host=host, port=port,
+                         visual_stim_kwargs=visual_stim_kwargs,
+                         loco_class=loco_class, loco_kwargs=loco_kwargs,
                          daq_class=daq_class, daq_kwargs=daq_kwargs)
-    
\ No newline at end of file
+
+        self.register_function_on_root(self.request_ack, "request_ack")
+        self.register_function_on_root(self.binary_payloads_hello, "binary_payloads_hello")
+        self.register_function_on_root(labpack_util.preload_resources, "preload_resources")
+        self.register_function_on_root(labpack_distribution.render_noise_movie, "render_noise_movie")
+
+        if profile_dir is not None:
+            self.register_function_on_root(self.get_render_profile, "get_render_profile")
+            self.register_function_on_root(self.reset_render_profile, "reset_render_profile")
+            self.register_function_on_root(self.dump_render_profile, "dump_render_profile")
+
+    def register_function_on_root(self, function, name=None):
+        '''
+        Functions on root receive NumPy arrays for any binary payloads in their arguments (see labpack.payload).
+        The client only encodes screen requests for stimuli that decode them (see labpack.payload.DECODING_STIMULI).
+        '''
+        if name is None:
+            name = function.__name__
+        super().register_function_on_root(payload.decode_payload(function), name)
+
+    def binary_payloads_hello(self, version=None):
+        '''
+        Tell the client that this server decodes binary payloads, and which version.
+        '''
+        self.write_request_list([{'name': 'binary_payloads_ack', 'args': [payload.PAYLOAD_VERSION], 'kwargs': {}}])
+
+    def request_ack(self, token=None):
+        '''
+        Echo token back to the client, e.g. to confirm that an epoch's requests reached this rig.
+        See labpack.client.MultiRigClient.
+        '''
+        self.write_request_list([{'name': 'receive_ack', 'args': [token], 'kwargs': {}}])
+
+    def get_render_profile(self):
+        '''
+        Send the client a summary of render timings for each display process: frame intervals, missed vsyncs,
+        and eval_at / upload times for each stimulus. Received by labpack.client.Client.receive_render_profile.
+        '''
+        records = profiler.load_records(self.profile_dir)
+        summary = {name: profiler.summarize(r, self.profile_refresh_rate) for name, r in records.items()}
+        self.write_request_list([{'name': 'receive_render_profile', 'args': [summary], 'kwargs': {}}])
+        return summary
+
+    def reset_render_profile(self):
+        for path in profiler.get_profile_paths(self.profile_dir):
+            buffer = np.load(path, mmap_mode='r+')
+            buffer['seq'] = 0
+            buffer.flush()
+
+    def dump_render_profile(self, file_path=None):
+        '''
+        Save the records from all display processes to a single .npz file, one array per display process.
+        '''
+        if file_path is None:
+            file_path = os.path.join(self.profile_dir, 'render_profile.npz')
+        records = profiler.load_records(self.profile_dir)
+        np.savez(file_path, **{os.path.splitext(name)[0]: r for name, r in records.items()})
+        return file_path
+
+    def close(self):
+        if self.profile_dir is not None:
+            self.dump_render_profile()
+        super().close()
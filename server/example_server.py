@@ -2,10 +2,11 @@ from stimpack.visual_stim.screen import Screen, SubScreen
 from base_server import BaseServer
 
 class ExampleServer(BaseServer):
-    def __init__(self, visual_stim_kwargs={}, loco_class=None, loco_kwargs={}, daq_class=None, daq_kwargs={}):
+    def __init__(self, visual_stim_kwargs={}, loco_class=None, loco_kwargs={}, daq_class=None, daq_kwargs={}, profile_dir=None, profile_refresh_rate=60):
         super().__init__(visual_stim_kwargs=visual_stim_kwargs, 
                          loco_class=loco_class, loco_kwargs=loco_kwargs, 
-                         daq_class=daq_class, daq_kwargs=daq_kwargs)
+                         daq_class=daq_class, daq_kwargs=daq_kwargs,
+                         profile_dir=profile_dir, profile_refresh_rate=profile_refresh_rate)
 
 def create_subscreen(name):
     if name == 'aux':
@@ -30,9 +31,11 @@ def main():
     visual_stim_kwargs = {'screens': [aux_screen, another_screen]}
 
     # Initialize server object, inheriting BaseServer. Define locomotion and daq classes and kwargs as desired.
+    # Set profile_dir to record per-frame render timings (query with "get_render_profile" from the client).
     server = ExampleServer(visual_stim_kwargs=visual_stim_kwargs, 
                            loco_class=None, loco_kwargs={}, 
-                           daq_class=None, daq_kwargs={})
+                           daq_class=None, daq_kwargs={},
+                           profile_dir=None, profile_refresh_rate=60)
 
     # Register any server-side functions to be called from the client.
     server.register_function_on_root(lambda: print("Hello, Server! From Client"), "hello_server")